@@ -83,6 +83,33 @@ DATABASES = {
 }
 
 
+# Serve the bookmark list from an in-process read model instead of querying
+# the database on every request (see bookmarks/readmodel.py). Every worker
+# process keeps its own copy, and picks up bookmarks changed by any worker,
+# including through the admin, when it next checks the shared change log, at
+# most every BOOKMARKS_READ_MODEL_CHECK_INTERVAL seconds. Changes are only
+# logged while this is enabled.
+
+BOOKMARKS_READ_MODEL = False
+
+BOOKMARKS_READ_MODEL_CHECK_INTERVAL = 1
+
+
+# Store snapshots of bookmarked pages in this directory (see bookmarks/archive.py);
+# archiving is disabled when this is None
+
+BOOKMARKS_ARCHIVE_DIR = None
+
+BOOKMARKS_ARCHIVE_MAX_BYTES = 1024 ** 3
+
+# Give up on downloads after this many seconds without data, and do not
+# archive pages larger than this many bytes
+
+BOOKMARKS_ARCHIVE_TIMEOUT = 10
+
+BOOKMARKS_ARCHIVE_MAX_PAGE_BYTES = 10 * 1024 ** 2
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -1,7 +1,10 @@
 from django.contrib import admin
 
-from .models import Bookmark, Resource, Tag
+from .models import ArchivedContent, Bookmark, BookmarkChange, Resource, Snapshot, Tag
 
 admin.site.register(Tag)
 admin.site.register(Resource)
 admin.site.register(Bookmark)
+admin.site.register(Snapshot)
+admin.site.register(ArchivedContent)
+admin.site.register(BookmarkChange)
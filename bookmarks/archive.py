@@ -0,0 +1,289 @@
+"""
+Opt-in archive of page snapshots for bookmarked resources.
+
+Enabled by setting ``BOOKMARKS_ARCHIVE_DIR``. Page bodies are streamed to disk
+through a compressor (zstd if the ``zstandard`` package is installed, gzip
+otherwise) and stored under the SHA-256 digest of the uncompressed body, so
+identical bodies are only stored once. When the compressed size of the
+archive exceeds ``BOOKMARKS_ARCHIVE_MAX_BYTES``, the least recently accessed
+bodies, and the snapshots that refer to them, are evicted.
+
+Downloads give up after ``BOOKMARKS_ARCHIVE_TIMEOUT`` seconds without data,
+and pages larger than ``BOOKMARKS_ARCHIVE_MAX_PAGE_BYTES`` are not archived.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import time
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from threading import Thread
+from typing import BinaryIO, Iterable, Iterator, Optional
+
+import requests
+from django.conf import settings
+from django.db import connection
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import ArchivedContent, Resource, Snapshot
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_BYTES = 1024 ** 3
+DEFAULT_MAX_PAGE_BYTES = 10 * 1024 ** 2
+DEFAULT_TIMEOUT = 10
+EXTENSIONS = {'zstd': '.zst', 'gzip': '.gz'}
+INCOMING_PREFIX = '.incoming-'
+# incoming files older than this were left behind by a killed thread or process
+STALE_INCOMING_SECONDS = 60 * 60
+
+
+class PageTooLarge(Exception):
+    pass
+
+
+def limit_size(chunks: Iterable[bytes], max_bytes: int) -> Iterator[bytes]:
+    """
+    Passes the chunks through, raising PageTooLarge as soon as they add up to
+    more than ``max_bytes``.
+    """
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size > max_bytes:
+            raise PageTooLarge(f'Page is larger than {max_bytes} bytes')
+        yield chunk
+
+
+class BodyRange:
+    """
+    Iterates over part of an already opened body, closing it when done. Can be
+    closed without being iterated, e.g. by a StreamingHttpResponse that is
+    never sent.
+    """
+
+    def __init__(self, body: BinaryIO, start: int, end: int):
+        self.body = body
+        self.start = start
+        self.end = end
+
+    def __iter__(self) -> Iterator[bytes]:
+        with self.body:
+            # compressed streams can only be read forwards, so skip to the start
+            remaining = self.start
+            while remaining > 0:
+                skipped = self.body.read(min(CHUNK_SIZE, remaining))
+                if not skipped:
+                    return
+                remaining -= len(skipped)
+            remaining = self.end - self.start
+            while remaining > 0:
+                chunk = self.body.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+    def close(self):
+        self.body.close()
+
+
+class ArchiveStore:
+    def __init__(self, root: Path, max_bytes: int, encoding: Optional[str] = None):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        if encoding is None:
+            encoding = 'zstd' if zstandard is not None else 'gzip'
+        self.encoding = encoding
+
+    def path(self, digest: str, encoding: str) -> Path:
+        return self.root / digest[:2] / (digest[2:] + EXTENSIONS[encoding])
+
+    def _compressor(self, file: BinaryIO):
+        if self.encoding == 'zstd':
+            return zstandard.ZstdCompressor().stream_writer(file, closefd=False)
+        else:
+            return gzip.GzipFile(fileobj=file, mode='wb', mtime=0)
+
+    def write(self, chunks: Iterable[bytes]) -> ArchivedContent:
+        """
+        Compresses and stores a body given as an iterable of chunks, without
+        holding the whole body in memory. Returns the existing content if an
+        identical body is already stored.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        with NamedTemporaryFile(dir=self.root, prefix=INCOMING_PREFIX, delete=False) as file:
+            try:
+                compressor = self._compressor(file)
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    compressor.write(chunk)
+                compressor.close()
+            except BaseException:
+                os.unlink(file.name)
+                raise
+
+        digest = digest.hexdigest()
+        content = ArchivedContent.objects.filter(digest=digest).first()
+        if content is not None and self.path(digest, content.encoding).exists():
+            # deduplicate: keep the stored copy and drop the new one
+            os.unlink(file.name)
+            content.last_accessed = timezone.now()
+            content.save(update_fields=['last_accessed'])
+            return content
+
+        path = self.path(digest, self.encoding)
+        path.parent.mkdir(exist_ok=True)
+        os.replace(file.name, path)
+        content, _is_new = ArchivedContent.objects.update_or_create(digest=digest, defaults={
+            'encoding': self.encoding,
+            'size': size,
+            'stored_size': path.stat().st_size,
+            'last_accessed': timezone.now(),
+        })
+        self.evict(keep=content)
+        return content
+
+    def open(self, content: ArchivedContent) -> BinaryIO:
+        """
+        Returns a file object that reads the uncompressed body, and marks the
+        content as recently used. Raises FileNotFoundError or
+        ArchivedContent.DoesNotExist if the content has been evicted.
+        """
+        path = self.path(content.digest, content.encoding)
+        if content.encoding == 'zstd':
+            body = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        else:
+            body = gzip.open(path, 'rb')
+        # once open, the body stays readable even if it is evicted meanwhile
+        if not ArchivedContent.objects.filter(digest=content.digest).update(last_accessed=timezone.now()):
+            body.close()
+            raise ArchivedContent.DoesNotExist(content.digest)
+        return body
+
+    def read(self, content: ArchivedContent, start: int = 0, end: Optional[int] = None) -> BodyRange:
+        """
+        Opens the body right away, and returns an iterator over the
+        uncompressed bytes from ``start`` up to, but not including, ``end``.
+        """
+        return BodyRange(self.open(content), start, content.size if end is None else end)
+
+    def total_size(self) -> int:
+        return ArchivedContent.objects.aggregate(total=Sum('stored_size'))['total'] or 0
+
+    def remove_stale_incoming(self):
+        cutoff = time.time() - STALE_INCOMING_SECONDS
+        for path in self.root.glob(INCOMING_PREFIX + '*'):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+            except FileNotFoundError:
+                # removed by another thread or process meanwhile
+                pass
+
+    def evict(self, keep: Optional[ArchivedContent] = None):
+        """
+        Removes stale incoming files, then deletes the least recently accessed
+        content, other than ``keep``, until the archive fits in its size budget.
+        """
+        self.remove_stale_incoming()
+        excess = self.total_size() - self.max_bytes
+        if excess <= 0:
+            return
+        candidates = ArchivedContent.objects.order_by('last_accessed')
+        if keep is not None:
+            candidates = candidates.exclude(digest=keep.digest)
+        for content in candidates.iterator():
+            self.path(content.digest, content.encoding).unlink(missing_ok=True)
+            excess -= content.stored_size
+            # also deletes the snapshots of this content
+            content.delete()
+            if excess <= 0:
+                break
+
+
+def get_store() -> Optional[ArchiveStore]:
+    """
+    Returns the archive store configured in the settings, or None if archiving
+    is not enabled.
+    """
+    root = getattr(settings, 'BOOKMARKS_ARCHIVE_DIR', None)
+    if root is None:
+        return None
+    return ArchiveStore(root, getattr(settings, 'BOOKMARKS_ARCHIVE_MAX_BYTES', DEFAULT_MAX_BYTES))
+
+
+def latest_snapshot(resource: Resource) -> Optional[Snapshot]:
+    """
+    Returns the most recent snapshot of the resource at its current URI, or
+    None if there is none or archiving is not enabled.
+    """
+    if get_store() is None:
+        return None
+    snapshots = resource.snapshots.filter(uri=resource.uri).select_related('content')
+    return snapshots.order_by('-fetched').first()
+
+
+def archive_resource(resource: Resource) -> Optional[Snapshot]:
+    """
+    Downloads the resource and stores a snapshot of it. Returns None if
+    archiving is not enabled or the download failed.
+    """
+    store = get_store()
+    if store is None:
+        return None
+    timeout = getattr(settings, 'BOOKMARKS_ARCHIVE_TIMEOUT', DEFAULT_TIMEOUT)
+    max_page_bytes = getattr(settings, 'BOOKMARKS_ARCHIVE_MAX_PAGE_BYTES', DEFAULT_MAX_PAGE_BYTES)
+    # the resource's URI may change while the page is downloaded
+    uri = resource.uri
+    try:
+        with requests.get(uri, stream=True, timeout=timeout) as response:
+            if not response.ok:
+                logger.warning('Not archiving %s: HTTP status %d', uri, response.status_code)
+                return None
+            content = store.write(limit_size(response.iter_content(CHUNK_SIZE), max_page_bytes))
+            content_type = response.headers.get('Content-Type', 'application/octet-stream')
+    except (requests.RequestException, PageTooLarge) as e:
+        logger.warning('Not archiving %s: %s', uri, e)
+        return None
+    return Snapshot.objects.create(
+        resource=resource,
+        uri=uri,
+        content=content,
+        content_type=content_type,
+        fetched=timezone.now(),
+    )
+
+
+def _archive_and_close(resource: Resource):
+    try:
+        archive_resource(resource)
+    except Exception:
+        logger.exception('Archiving %s failed', resource.uri)
+    finally:
+        # this thread's database connection is not closed at the end of a request
+        connection.close()
+
+
+def archive_in_background(resource: Resource) -> Optional[Thread]:
+    """
+    Archives the resource in a separate thread, so that the request saving the
+    bookmark does not wait for the download. Returns the thread, or None if
+    archiving is not enabled.
+    """
+    if get_store() is None:
+        return None
+    thread = Thread(target=_archive_and_close, args=(resource,), daemon=True)
+    thread.start()
+    return thread
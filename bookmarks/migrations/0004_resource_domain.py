@@ -0,0 +1,41 @@
+# Generated by Django 3.2.9 on 2026-10-19 12:00
+
+from urllib.parse import urlparse
+
+from django.db import migrations, models
+
+
+def domain_of(uri):
+    try:
+        return urlparse(uri).hostname or ''
+    except ValueError:
+        return ''
+
+
+def populate_domain(apps, schema_editor):
+    Resource = apps.get_model('bookmarks', 'Resource')
+    batch = []
+    for resource in Resource.objects.only('id', 'uri').iterator():
+        resource.domain = domain_of(resource.uri)
+        batch.append(resource)
+        if len(batch) >= 1000:
+            Resource.objects.bulk_update(batch, ['domain'])
+            batch = []
+    if batch:
+        Resource.objects.bulk_update(batch, ['domain'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookmarks', '0003_alter_bookmark_deleted'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resource',
+            name='domain',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=255),
+        ),
+        migrations.RunPython(populate_domain, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.2.9 on 2026-10-19 11:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookmarks', '0004_resource_domain'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedContent',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('encoding', models.CharField(max_length=8)),
+                ('size', models.BigIntegerField()),
+                ('stored_size', models.BigIntegerField()),
+                ('last_accessed', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Snapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_type', models.CharField(max_length=255)),
+                ('fetched', models.DateTimeField()),
+                ('content', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='bookmarks.archivedcontent')),
+                ('resource', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='bookmarks.resource')),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.2.9 on 2026-10-19 11:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookmarks', '0005_snapshots'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookmarkChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bookmark_id', models.BigIntegerField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.9 on 2026-10-19 11:41
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookmarks', '0006_bookmarkchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookmarkchange',
+            name='changed',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.9 on 2026-10-19 12:30
+
+from django.db import migrations, models
+
+
+def populate_uri(apps, schema_editor):
+    Snapshot = apps.get_model('bookmarks', 'Snapshot')
+    batch = []
+    for snapshot in Snapshot.objects.select_related('resource').only('id', 'resource', 'resource__uri').iterator():
+        snapshot.uri = snapshot.resource.uri
+        batch.append(snapshot)
+        if len(batch) >= 1000:
+            Snapshot.objects.bulk_update(batch, ['uri'])
+            batch = []
+    if batch:
+        Snapshot.objects.bulk_update(batch, ['uri'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookmarks', '0007_bookmarkchange_changed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snapshot',
+            name='uri',
+            field=models.CharField(default='', max_length=1024),
+            preserve_default=False,
+        ),
+        migrations.RunPython(populate_uri, migrations.RunPython.noop),
+    ]
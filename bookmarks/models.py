@@ -1,8 +1,21 @@
-from collections import Mapping
-from datetime import datetime
-from typing import Any
+from collections.abc import Mapping
+from datetime import datetime, timedelta
+from typing import Any, Iterable, List, Optional, Set, Tuple
+from urllib.parse import urlparse
 
 from django.db import models
+from django.db.models import Count, Max, Min, Q
+from django.utils import timezone
+
+FACET_LIMIT = 10
+
+
+def domain_of(uri: str) -> str:
+    try:
+        return urlparse(uri).hostname or ''
+    except ValueError:
+        # e.g. an unterminated IPv6 address; the form accepts any string as a URI
+        return ''
 
 
 class Tag(models.Model):
@@ -16,10 +29,46 @@ class Resource(models.Model):
     uri = models.CharField(max_length=1024, unique=True)
     title = models.CharField(max_length=1024)
     tags = models.ManyToManyField(Tag, related_name='resources')
+    # denormalized from uri so that filtering and grouping by site can use an index
+    domain = models.CharField(max_length=255, blank=True, default='', db_index=True)
 
     def __str__(self):
         return self.uri
 
+    def save(self, *args, **kwargs):
+        self.domain = domain_of(self.uri)
+        super().save(*args, **kwargs)
+
+
+class BookmarkQuerySet(models.QuerySet):
+    def filter_by(self, tags: Iterable[str] = (), domain: Optional[str] = None) -> 'BookmarkQuerySet':
+        bookmarks = self
+        # chaining a filter per tag gives the intersection of all tags
+        for tag in tags:
+            bookmarks = bookmarks.filter(resource__tags__value=tag)
+        if domain:
+            bookmarks = bookmarks.filter(resource__domain=domain.lower())
+        return bookmarks
+
+    def domain_counts(self, limit: int = FACET_LIMIT) -> List[dict]:
+        return list(
+            Resource.objects.filter(bookmark__in=self.order_by().values('id'))
+            .values('domain')
+            .annotate(count=Count('id'))
+            .order_by('-count', 'domain')[:limit]
+        )
+
+    def tag_counts(self, limit: int = FACET_LIMIT) -> List[dict]:
+        return list(
+            Tag.objects.filter(resources__bookmark__in=self.order_by().values('id'))
+            .values('value')
+            .annotate(count=Count('resources'))
+            .order_by('-count', 'value')[:limit]
+        )
+
+    def last_modified(self) -> Optional[datetime]:
+        return self.aggregate(last_modified=Max('modified'))['last_modified']
+
 
 class Bookmark(models.Model):
     resource = models.ForeignKey(to=Resource, on_delete=models.CASCADE, related_name='bookmark')
@@ -27,6 +76,8 @@ class Bookmark(models.Model):
     modified = models.DateTimeField()
     deleted = models.DateTimeField(blank=True, null=True)
 
+    objects = BookmarkQuerySet.as_manager()
+
     def __str__(self):
         return self.resource.title
 
@@ -70,3 +121,90 @@ class Bookmark(models.Model):
             self.modified = timestamp
             self.resource.save()
             self.save()
+
+
+class BookmarkChange(models.Model):
+    """
+    Log of changed bookmarks, written by the receivers in signals.py while the
+    read model is enabled. The ids double as a version counter shared by all
+    processes, so that in-process caches of bookmark data can tell whether they
+    are stale and which bookmarks to reload.
+
+    Databases other than SQLite can commit ids out of order, so the version
+    only advances past changes older than COMMIT_MARGIN; newer changes are
+    reported again on every check until then. A change whose transaction takes
+    longer than that to commit can be missed.
+    """
+    # how long a transaction writing a change may take to commit
+    COMMIT_MARGIN = timedelta(seconds=10)
+    # how long changes are kept; processes further behind reload everything
+    RETENTION = timedelta(hours=1)
+
+    bookmark_id = models.BigIntegerField()
+    changed = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f'{self.id}: {self.bookmark_id}'
+
+    @classmethod
+    def record(cls, bookmark_ids: Iterable[int]):
+        now = timezone.now()
+        cls.objects.bulk_create([cls(bookmark_id=bookmark_id, changed=now) for bookmark_id in bookmark_ids])
+        # keep the latest change, so that a pruned log can still be told from an empty one
+        latest = cls.objects.aggregate(latest=Max('id'))['latest']
+        cls.objects.filter(changed__lt=now - cls.RETENTION, id__lt=latest).delete()
+
+    @classmethod
+    def _bounds(cls) -> Tuple[Optional[int], Optional[int]]:
+        settled = timezone.now() - cls.COMMIT_MARGIN
+        bounds = cls.objects.aggregate(oldest=Min('id'), settled=Max('id', filter=Q(changed__lt=settled)))
+        return bounds['oldest'], bounds['settled']
+
+    @classmethod
+    def current_version(cls) -> int:
+        oldest, settled = cls._bounds()
+        if settled is not None:
+            return settled
+        return oldest - 1 if oldest is not None else 0
+
+    @classmethod
+    def since(cls, version: int) -> Tuple[int, Optional[Set[int]]]:
+        """
+        Returns the current version and the ids of the bookmarks changed after
+        the given version, or None instead of the ids if some of those changes
+        have already been pruned and everything has to be reloaded.
+        """
+        oldest, settled = cls._bounds()
+        if oldest is not None and oldest > version + 1:
+            return cls.current_version(), None
+        changed = set(cls.objects.filter(id__gt=version).values_list('bookmark_id', flat=True))
+        if settled is not None:
+            version = max(version, settled)
+        return version, changed
+
+
+class ArchivedContent(models.Model):
+    """
+    Compressed page body in the archive store, addressed by the SHA-256 digest
+    of the uncompressed body so that identical snapshots share one file.
+    """
+    digest = models.CharField(max_length=64, primary_key=True)
+    encoding = models.CharField(max_length=8)
+    size = models.BigIntegerField()
+    stored_size = models.BigIntegerField()
+    last_accessed = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.digest
+
+
+class Snapshot(models.Model):
+    resource = models.ForeignKey(to=Resource, on_delete=models.CASCADE, related_name='snapshots')
+    # the resource's URI when it was fetched, since the URI can be edited later
+    uri = models.CharField(max_length=1024)
+    content = models.ForeignKey(to=ArchivedContent, on_delete=models.CASCADE, related_name='snapshots')
+    content_type = models.CharField(max_length=255)
+    fetched = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.uri} ({self.fetched})'
@@ -0,0 +1,405 @@
+"""
+Optional in-process read model of the bookmark list.
+
+When the ``BOOKMARKS_READ_MODEL`` setting is true, listing, tag and domain
+filtering, paging and facet counts are served from compact columns held in
+memory instead of querying the database on every request. The columns are
+loaded on first use. At most every ``BOOKMARKS_READ_MODEL_CHECK_INTERVAL``
+seconds, each process looks up the bookmarks recorded in ``BookmarkChange``
+(by the receivers in signals.py, for changes made in any process) since it
+last checked, and reloads only those, or everything if it has fallen so far
+behind that some of those changes have been pruned.
+"""
+import logging
+import sys
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from time import monotonic
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from django.conf import settings
+from django.dispatch import receiver
+
+from .models import FACET_LIMIT, Bookmark, BookmarkChange, BookmarkQuerySet, Tag
+from .signals import bookmarks_changed
+
+logger = logging.getLogger(__name__)
+
+MICROSECOND = timedelta(microseconds=1)
+
+
+def _epoch() -> datetime:
+    return datetime(1970, 1, 1, tzinfo=timezone.utc if settings.USE_TZ else None)
+
+
+def _to_micros(timestamp: datetime) -> int:
+    return (timestamp - _epoch()) // MICROSECOND
+
+
+def _from_micros(micros: int) -> datetime:
+    return _epoch() + micros * MICROSECOND
+
+
+def _contains(ids: array, bookmark_id: int) -> bool:
+    i = bisect_left(ids, bookmark_id)
+    return i < len(ids) and ids[i] == bookmark_id
+
+
+class TagRow(NamedTuple):
+    id: int
+    value: str
+
+    def __str__(self):
+        return self.value
+
+
+class TagRows(tuple):
+    """
+    Tags of a ResourceRow; all() mirrors the related manager on Resource.
+    """
+
+    def all(self):
+        return self
+
+
+class ResourceRow(NamedTuple):
+    id: int
+    uri: str
+    title: str
+    domain: str
+    tags: TagRows
+
+    def __str__(self):
+        return self.uri
+
+
+class BookmarkRow(NamedTuple):
+    """
+    Read-only stand-in for a Bookmark, with the attributes the list views and
+    annotations use.
+    """
+    id: int
+    resource: ResourceRow
+    created: datetime
+    modified: datetime
+
+    def __str__(self):
+        return self.resource.title
+
+
+class ReadModel:
+    """
+    Column store of all bookmarks, ordered by ascending (created, id).
+
+    Instances are never modified once published; ``refreshed()`` returns a
+    copy with the changes applied, so requests holding an older instance keep
+    a consistent view.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.ids = array('q')
+        self.created = array('q')
+        self.modified = array('q')
+        self.resource_ids = array('q')
+        self.titles: List[str] = []
+        self.uris: List[str] = []
+        self.domains: List[str] = []
+        self.tags: List[Tuple[str, ...]] = []
+        # sorted arrays of bookmark ids, keyed by interned tag value or domain
+        self.tag_index: Dict[str, array] = {}
+        self.domain_index: Dict[str, array] = {}
+        self.tag_ids: Dict[str, int] = {}
+        self._positions: Optional[Dict[int, int]] = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, version: int) -> 'ReadModel':
+        model = cls()
+        model.version = version
+        # Tag.value is not unique, so map every tag id to its value
+        tag_values = {id: sys.intern(value) for id, value in Tag.objects.values_list('id', 'value').iterator()}
+        for id, value in tag_values.items():
+            model.tag_ids.setdefault(value, id)
+        tags_by_resource = defaultdict(list)
+        for resource_id, tag_id in Tag.resources.through.objects.values_list('resource_id', 'tag_id').iterator():
+            tags_by_resource[resource_id].append(tag_values[tag_id])
+        for row in model._rows(Bookmark.objects.order_by('created', 'id')):
+            model._append(*row, tags=tuple(tags_by_resource[row[3]]))
+        model._sort_indexes()
+        logger.info('Loaded %d bookmarks into the read model, using %d bytes (%d bytes per 100k bookmarks)',
+                    len(model), model.memory_usage(), model.memory_per_100k())
+        return model
+
+    @staticmethod
+    def _rows(bookmarks: BookmarkQuerySet):
+        return bookmarks.values_list(
+            'id', 'created', 'modified', 'resource_id', 'resource__title', 'resource__uri', 'resource__domain'
+        ).iterator()
+
+    def _append(self, id, created, modified, resource_id, title, uri, domain, tags):
+        self.ids.append(id)
+        self.created.append(_to_micros(created))
+        self.modified.append(_to_micros(modified))
+        self.resource_ids.append(resource_id)
+        self.titles.append(title)
+        self.uris.append(uri)
+        domain = sys.intern(domain)
+        self.domains.append(domain)
+        self.tags.append(tags)
+        for tag in tags:
+            self.tag_index.setdefault(tag, array('q')).append(id)
+        self.domain_index.setdefault(domain, array('q')).append(id)
+
+    def _sort_indexes(self):
+        # rows are appended in created order, so the indexes still need sorting by id
+        for index in (self.tag_index, self.domain_index):
+            for key, ids in index.items():
+                index[key] = array('q', sorted(ids))
+
+    @property
+    def positions(self) -> Dict[int, int]:
+        if self._positions is None:
+            self._positions = {id: pos for pos, id in enumerate(self.ids)}
+        return self._positions
+
+    def refreshed(self, version: int, changed_ids: Iterable[int]) -> 'ReadModel':
+        """
+        Returns a copy of this read model with the given bookmarks reloaded
+        from the database. Copying the columns is a flat copy of arrays and
+        lists of references; only the changed rows are queried and re-indexed.
+        """
+        model = self.__class__()
+        model.version = version
+        for name in ('ids', 'created', 'modified', 'resource_ids'):
+            setattr(model, name, array('q', getattr(self, name)))
+        for name in ('titles', 'uris', 'domains', 'tags'):
+            setattr(model, name, list(getattr(self, name)))
+        model.tag_ids = dict(self.tag_ids)
+        model.tag_index = dict(self.tag_index)
+        model.domain_index = dict(self.domain_index)
+
+        changed_ids = set(changed_ids)
+        # the copy has the same positions as this model until rows are removed
+        model._remove_positions([self.positions[id] for id in changed_ids & self.positions.keys()])
+        bookmarks = Bookmark.objects.filter(id__in=changed_ids).prefetch_related('resource__tags')
+        for bookmark in bookmarks.select_related('resource'):
+            tags = []
+            for tag in bookmark.resource.tags.all():
+                value = sys.intern(tag.value)
+                model.tag_ids.setdefault(value, tag.id)
+                tags.append(value)
+            model._insert(bookmark, tuple(tags))
+        return model
+
+    def _remove_positions(self, positions: Iterable[int]):
+        # delete from the end, so the remaining positions stay valid
+        for pos in sorted(positions, reverse=True):
+            id = self.ids[pos]
+            for tag in self.tags[pos]:
+                self._index_discard(self.tag_index, tag, id)
+            self._index_discard(self.domain_index, self.domains[pos], id)
+            for column in (self.ids, self.created, self.modified, self.resource_ids,
+                           self.titles, self.uris, self.domains, self.tags):
+                del column[pos]
+        self._positions = None
+
+    def _insert(self, bookmark: Bookmark, tags: Tuple[str, ...]):
+        created = _to_micros(bookmark.created)
+        pos = bisect_left(self.created, created)
+        while pos < len(self) and self.created[pos] == created and self.ids[pos] < bookmark.id:
+            pos += 1
+        domain = sys.intern(bookmark.resource.domain)
+        self.ids.insert(pos, bookmark.id)
+        self.created.insert(pos, created)
+        self.modified.insert(pos, _to_micros(bookmark.modified))
+        self.resource_ids.insert(pos, bookmark.resource_id)
+        self.titles.insert(pos, bookmark.resource.title)
+        self.uris.insert(pos, bookmark.resource.uri)
+        self.domains.insert(pos, domain)
+        self.tags.insert(pos, tags)
+        for tag in tags:
+            self._index_add(self.tag_index, tag, bookmark.id)
+        self._index_add(self.domain_index, domain, bookmark.id)
+        self._positions = None
+
+    @staticmethod
+    def _index_add(index: Dict[str, array], key: str, id: int):
+        # copy before modifying, since the array may be shared with an older read model
+        ids = array('q', index.get(key, ()))
+        insort(ids, id)
+        index[key] = ids
+
+    @staticmethod
+    def _index_discard(index: Dict[str, array], key: str, id: int):
+        ids = array('q', index.get(key, ()))
+        i = bisect_left(ids, id)
+        if i < len(ids) and ids[i] == id:
+            del ids[i]
+        if ids:
+            index[key] = ids
+        else:
+            index.pop(key, None)
+
+    def filter_by(self, tags: Iterable[str] = (), domain: Optional[str] = None) -> 'ReadModelBookmarks':
+        postings = [self.tag_index.get(tag, array('q')) for tag in tags]
+        if domain:
+            postings.append(self.domain_index.get(domain.lower(), array('q')))
+        if not postings:
+            return ReadModelBookmarks(self, range(len(self) - 1, -1, -1), unfiltered=True)
+
+        # probe the other id arrays with each id from the shortest one
+        postings.sort(key=len)
+        shortest, others = postings[0], postings[1:]
+        ids = [id for id in shortest if all(_contains(other, id) for other in others)]
+        return ReadModelBookmarks(self, sorted((self.positions[id] for id in ids), reverse=True))
+
+    def bookmark(self, pos: int) -> BookmarkRow:
+        resource = ResourceRow(
+            id=self.resource_ids[pos],
+            uri=self.uris[pos],
+            title=self.titles[pos],
+            domain=self.domains[pos],
+            tags=TagRows(TagRow(self.tag_ids[value], value) for value in self.tags[pos]),
+        )
+        return BookmarkRow(
+            id=self.ids[pos],
+            resource=resource,
+            created=_from_micros(self.created[pos]),
+            modified=_from_micros(self.modified[pos]),
+        )
+
+    def memory_usage(self) -> int:
+        """
+        Approximate number of bytes held by this read model, counting shared
+        (interned) strings and tag tuples once.
+        """
+        size = sum(sys.getsizeof(column) for column in (
+            self.ids, self.created, self.modified, self.resource_ids,
+            self.titles, self.uris, self.domains, self.tags,
+            self.tag_index, self.domain_index, self.tag_ids
+        ))
+        size += sum(sys.getsizeof(s) for s in self.titles)
+        size += sum(sys.getsizeof(s) for s in self.uris)
+        size += sum(sys.getsizeof(s) for s in set(self.domains))
+        size += sum(sys.getsizeof(t) for t in {id(t): t for t in self.tags}.values())
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in self.tag_index.items())
+        size += sum(sys.getsizeof(v) for v in self.domain_index.values())
+        if self._positions is not None:
+            size += sys.getsizeof(self._positions)
+        return size
+
+    def memory_per_100k(self) -> int:
+        return self.memory_usage() * 100_000 // len(self) if len(self) else 0
+
+
+class ReadModelBookmarks(Sequence):
+    """
+    Filtered list of bookmarks from the read model, ordered by descending
+    creation time. Supports the parts of the BookmarkQuerySet interface used
+    by the views, so it can be passed to a Paginator in place of one.
+    """
+
+    def __init__(self, model: ReadModel, positions: Sequence[int], unfiltered: bool = False):
+        self.model = model
+        self.positions = positions
+        self.unfiltered = unfiltered
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self.model.bookmark(pos) for pos in self.positions[item]]
+        return self.model.bookmark(self.positions[item])
+
+    def count(self) -> int:
+        return len(self)
+
+    def domain_counts(self, limit: int = FACET_LIMIT) -> List[dict]:
+        if self.unfiltered:
+            counts = {domain: len(ids) for domain, ids in self.model.domain_index.items()}
+        else:
+            counts = Counter(self.model.domains[pos] for pos in self.positions)
+        return [
+            {'domain': domain, 'count': count}
+            for domain, count in sorted(counts.items(), key=lambda c: (-c[1], c[0]))[:limit]
+        ]
+
+    def tag_counts(self, limit: int = FACET_LIMIT) -> List[dict]:
+        if self.unfiltered:
+            counts = {tag: len(ids) for tag, ids in self.model.tag_index.items()}
+        else:
+            counts = Counter(tag for pos in self.positions for tag in self.model.tags[pos])
+        return [
+            {'value': value, 'count': count}
+            for value, count in sorted(counts.items(), key=lambda c: (-c[1], c[0]))[:limit]
+        ]
+
+    def last_modified(self) -> Optional[datetime]:
+        if not self.positions:
+            return None
+        return _from_micros(max(self.model.modified[pos] for pos in self.positions))
+
+
+_model: Optional[ReadModel] = None
+_checked: Optional[float] = None
+_lock = Lock()
+
+
+def get_read_model() -> ReadModel:
+    """
+    Returns the current read model, loading it on first use and reloading any
+    bookmarks changed (by any process) since it was last brought up to date.
+    """
+    global _model, _checked
+    model = _model
+    interval = getattr(settings, 'BOOKMARKS_READ_MODEL_CHECK_INTERVAL', 1)
+    if model is not None and _checked is not None and monotonic() - _checked < interval:
+        return model
+    with _lock:
+        if _model is None:
+            # take the version first, so changes made while loading are reloaded next time
+            _model = ReadModel.load(BookmarkChange.current_version())
+        else:
+            version, changed = BookmarkChange.since(_model.version)
+            if changed is None:
+                _model = ReadModel.load(version)
+            elif changed:
+                _model = _model.refreshed(version, changed)
+        _checked = monotonic()
+        return _model
+
+
+@receiver(bookmarks_changed)
+def _expire_check(**kwargs):
+    # changes made in this process show up on the next request, whatever the check interval
+    global _checked
+    _checked = None
+
+
+def reload():
+    """
+    Discards the read model, so that it is loaded from scratch on next use.
+    """
+    global _model, _checked
+    with _lock:
+        _model = None
+        _checked = None
+
+
+def filtered_bookmarks(
+        tags: Iterable[str] = (), domain: Optional[str] = None
+) -> Union[BookmarkQuerySet, ReadModelBookmarks]:
+    """
+    Returns the bookmarks with all the given tags and on the given domain,
+    newest first, from the read model if it is enabled or the database if not.
+    """
+    if getattr(settings, 'BOOKMARKS_READ_MODEL', False):
+        return get_read_model().filter_by(tags, domain)
+    return Bookmark.objects.filter_by(tags, domain).order_by('-created', '-id')
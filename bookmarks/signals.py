@@ -0,0 +1,58 @@
+"""
+Records which bookmarks change, through any write path (the views, the admin,
+the shell), so that read models in every process can reload them. Nothing is
+recorded unless the ``BOOKMARKS_READ_MODEL`` setting is true.
+"""
+from typing import Iterable
+
+from django.conf import settings
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import Signal, receiver
+
+from .models import Bookmark, BookmarkChange, Resource, Tag
+
+# sent with the set of bookmark_ids after they have been recorded
+bookmarks_changed = Signal()
+
+
+def record_changes(bookmark_ids: Iterable[int]):
+    if not getattr(settings, 'BOOKMARKS_READ_MODEL', False):
+        return
+    # bookmark_ids is often a lazy queryset, only evaluated here
+    bookmark_ids = set(bookmark_ids)
+    if bookmark_ids:
+        BookmarkChange.record(bookmark_ids)
+        bookmarks_changed.send(sender=BookmarkChange, bookmark_ids=bookmark_ids)
+
+
+@receiver(post_save, sender=Bookmark)
+@receiver(post_delete, sender=Bookmark)
+def bookmark_changed(sender, instance: Bookmark, **kwargs):
+    record_changes([instance.pk])
+
+
+@receiver(post_save, sender=Resource)
+def resource_changed(sender, instance: Resource, **kwargs):
+    # deleting a resource deletes its bookmarks, which are recorded above
+    record_changes(instance.bookmark.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Tag)
+@receiver(pre_delete, sender=Tag)
+def tag_changed(sender, instance: Tag, **kwargs):
+    # on delete, this runs in the same transaction as the deletion, before the
+    # tag is removed from its resources without sending m2m_changed
+    record_changes(Bookmark.objects.filter(resource__tags=instance).values_list('id', flat=True))
+
+
+@receiver(m2m_changed, sender=Resource.tags.through)
+def tags_changed(sender, instance, action: str, reverse: bool, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        resource_ids = [instance.pk]
+    elif action == 'pre_clear':
+        resource_ids = instance.resources.values_list('id', flat=True)
+    else:
+        resource_ids = pk_set
+    record_changes(Bookmark.objects.filter(resource__in=resource_ids).values_list('id', flat=True))
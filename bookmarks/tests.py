@@ -1,3 +1,511 @@
-from django.test import TestCase
+import gc
+import os
+import time
+import warnings
+from datetime import datetime, timedelta, timezone
+from tempfile import TemporaryDirectory
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.db.models import Max
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+
+from . import readmodel
+from .archive import INCOMING_PREFIX, STALE_INCOMING_SECONDS, ArchiveStore, archive_resource
+from .models import ArchivedContent, Bookmark, BookmarkChange, Resource, Snapshot, Tag
+from .views import byte_range
+
+NOW = datetime(2021, 12, 1, tzinfo=timezone.utc)
+
+
+def create_bookmark(uri: str, tags: str, created: datetime) -> Bookmark:
+    resource = Resource.objects.create(uri=uri, title=uri)
+    bookmark = Bookmark.objects.create(resource=resource, created=created, modified=created)
+    bookmark.update_tags(tags)
+    return bookmark
+
+
+class BookmarkFixtures:
+    def setUp(self):
+        start = datetime(2021, 11, 1, tzinfo=timezone.utc)
+        self.bookmarks = [
+            create_bookmark(uri, tags, start + timedelta(days=i))
+            for i, (uri, tags) in enumerate([
+                ('https://example.com/a', 'python django'),
+                ('https://Example.COM:8080/b', 'python'),
+                ('https://example.org/c', 'python django'),
+                ('https://example.org/d', 'rust'),
+            ])
+        ]
+
+
+class DomainTest(TestCase):
+    def test_domain_is_lowercased_without_port(self):
+        resource = Resource.objects.create(uri='https://Example.COM:8080/page', title='Example')
+        self.assertEqual(resource.domain, 'example.com')
+
+    def test_malformed_uri_has_no_domain(self):
+        resource = Resource.objects.create(uri='http://[abc/x', title='Malformed')
+        self.assertEqual(resource.domain, '')
+
+    def test_uri_without_host_has_no_domain(self):
+        resource = Resource.objects.create(uri='urn:isbn:0451450523', title='Book')
+        self.assertEqual(resource.domain, '')
+
+    def test_domain_follows_uri_changes(self):
+        resource = Resource.objects.create(uri='https://example.com/page', title='Example')
+        resource.uri = 'http://example.org/page'
+        resource.save()
+        self.assertEqual(Resource.objects.get(pk=resource.pk).domain, 'example.org')
+
+
+class FilterTest(BookmarkFixtures, TestCase):
+    def test_tags_are_intersected(self):
+        bookmarks = Bookmark.objects.filter_by(['python', 'django']).order_by('created')
+        self.assertEqual(list(bookmarks), [self.bookmarks[0], self.bookmarks[2]])
+
+    def test_tags_and_domain(self):
+        bookmarks = Bookmark.objects.filter_by(['python', 'django'], 'Example.com')
+        self.assertEqual(list(bookmarks), [self.bookmarks[0]])
+
+    def test_unknown_tag(self):
+        self.assertFalse(Bookmark.objects.filter_by(['python', 'go']).exists())
+
+    def test_facet_counts(self):
+        bookmarks = Bookmark.objects.filter_by(['python'])
+        self.assertEqual(bookmarks.domain_counts(), [
+            {'domain': 'example.com', 'count': 2},
+            {'domain': 'example.org', 'count': 1},
+        ])
+        self.assertEqual(bookmarks.tag_counts(), [
+            {'value': 'python', 'count': 3},
+            {'value': 'django', 'count': 2},
+        ])
+
+    def test_facet_limit(self):
+        self.assertEqual(Bookmark.objects.all().tag_counts(limit=1), [{'value': 'python', 'count': 3}])
+
+    def test_last_modified(self):
+        self.assertEqual(Bookmark.objects.filter_by(['django']).last_modified(), self.bookmarks[2].modified)
+        self.assertIsNone(Bookmark.objects.filter_by(['go']).last_modified())
+
+
+class AnnotationCollectionTest(BookmarkFixtures, TestCase):
+    def test_filters_are_kept_in_links(self):
+        response = self.client.get(reverse('bookmarks_page'), {'tag': ['python', 'django'], 'domain': 'example.org'})
+        data = response.json()
+        url = 'http://testserver/bookmarks/?tag=python&tag=django&domain=example.org'
+        self.assertEqual(data['id'], url)
+        self.assertEqual(data['total'], 1)
+        self.assertEqual(data['first']['id'], url + '&page=1')
+        self.assertEqual(data['last'], url + '&page=1')
+        self.assertEqual([item['target']['id'] for item in data['first']['items']], ['https://example.org/c'])
+
+    def test_empty_collection(self):
+        data = self.client.get(reverse('bookmarks_page'), {'tag': 'go'}).json()
+        self.assertEqual(data['total'], 0)
+        self.assertIsNone(data['modified'])
+
+
+class BookmarkChangeTest(TestCase):
+    def test_not_recorded_when_read_model_disabled(self):
+        bookmark = create_bookmark('https://example.com/a', 'python', NOW)
+        bookmark.update_and_save({'title': 'Edited', 'uri': 'https://example.com/a', 'tags': 'django'}, NOW)
+        bookmark.delete()
+        self.assertFalse(BookmarkChange.objects.exists())
+
+    @override_settings(BOOKMARKS_READ_MODEL=True)
+    def test_recorded_for_new_bookmark(self):
+        bookmark = create_bookmark('https://example.com/a', 'python', NOW)
+        self.assertEqual(set(BookmarkChange.objects.values_list('bookmark_id', flat=True)), {bookmark.id})
+
+    def test_version_waits_for_commit_margin(self):
+        BookmarkChange.record([1, 2])
+        self.assertEqual(BookmarkChange.since(0), (0, {1, 2}))
+        BookmarkChange.objects.update(changed=NOW)
+        version = BookmarkChange.objects.aggregate(Max('id'))['id__max']
+        self.assertEqual(BookmarkChange.since(0), (version, {1, 2}))
+        self.assertEqual(BookmarkChange.since(version), (version, set()))
+        self.assertEqual(BookmarkChange.current_version(), version)
+
+    def test_old_changes_are_pruned(self):
+        BookmarkChange.record([1, 2])
+        BookmarkChange.objects.update(changed=NOW)
+        BookmarkChange.record([3])
+        self.assertEqual(list(BookmarkChange.objects.values_list('bookmark_id', flat=True)), [3])
+        # a process at version 0 missed the pruned changes
+        version, changed = BookmarkChange.since(0)
+        self.assertIsNone(changed)
+        self.assertEqual(BookmarkChange.since(version), (version, {3}))
+
+    def test_latest_change_is_kept(self):
+        BookmarkChange.record([1])
+        BookmarkChange.objects.update(changed=NOW)
+        BookmarkChange.record([])
+        self.assertEqual(BookmarkChange.objects.count(), 1)
+
+
+@override_settings(BOOKMARKS_READ_MODEL=True, BOOKMARKS_READ_MODEL_CHECK_INTERVAL=0)
+class ReadModelTest(BookmarkFixtures, TestCase):
+    FILTERS = [
+        ((), None),
+        (('python',), None),
+        (('python', 'django'), None),
+        ((), 'example.org'),
+        (('python',), 'EXAMPLE.com'),
+        (('go',), None),
+    ]
+
+    def setUp(self):
+        super().setUp()
+        readmodel.reload()
+
+    def tearDown(self):
+        readmodel.reload()
+
+    @staticmethod
+    def settle():
+        # let the read model advance past all changes so far, as it would after COMMIT_MARGIN
+        BookmarkChange.objects.update(changed=NOW)
+        readmodel.get_read_model()
+
+    @staticmethod
+    def results(tags, domain):
+        bookmarks = readmodel.filtered_bookmarks(tags, domain)
+        return {
+            'count': bookmarks.count(),
+            'bookmarks': [
+                (b.id, b.resource.uri, b.resource.title, b.resource.domain,
+                 sorted(t.value for t in b.resource.tags.all()), b.created, b.modified)
+                for b in bookmarks[:]
+            ],
+            'domains': bookmarks.domain_counts(),
+            'tags': bookmarks.tag_counts(),
+            'last_modified': bookmarks.last_modified(),
+        }
+
+    def assertSameAsDatabase(self):
+        for tags, domain in self.FILTERS:
+            with self.subTest(tags=tags, domain=domain):
+                with self.settings(BOOKMARKS_READ_MODEL=False):
+                    expected = self.results(tags, domain)
+                self.assertEqual(self.results(tags, domain), expected)
+
+    def test_same_as_database(self):
+        self.assertSameAsDatabase()
+
+    def test_no_queries_once_loaded(self):
+        with self.settings(BOOKMARKS_READ_MODEL_CHECK_INTERVAL=60):
+            readmodel.get_read_model()
+            with self.assertNumQueries(0):
+                self.results(('python',), None)
+
+    def test_ties_ordered_by_id(self):
+        created = self.bookmarks[1].created
+        for uri in ('https://example.net/x', 'https://example.net/y'):
+            create_bookmark(uri, 'python', created)
+        self.assertSameAsDatabase()
+
+    def test_duplicate_tag_values(self):
+        self.bookmarks[3].resource.tags.add(Tag.objects.create(value='python'))
+        self.assertSameAsDatabase()
+
+    def test_refreshed_after_edit(self):
+        self.settle()
+        self.bookmarks[0].update_and_save({'title': 'Edited', 'uri': 'https://example.net/a', 'tags': 'rust django'}, NOW)
+        self.assertSameAsDatabase()
+        self.assertEqual(readmodel.get_read_model().version, BookmarkChange.current_version())
+
+    def test_refreshed_after_new_bookmark(self):
+        self.settle()
+        bookmark = create_bookmark('https://example.net/new', '', self.bookmarks[0].created)
+        bookmark.update_and_save({'title': 'New', 'uri': 'https://example.net/new', 'tags': 'python'}, NOW)
+        self.assertSameAsDatabase()
+
+    def test_refreshed_after_changes_outside_update_and_save(self):
+        # as made through the admin
+        def edit_resource():
+            resource = Resource.objects.get(pk=self.bookmarks[0].resource_id)
+            resource.title = 'Edited'
+            resource.save()
+
+        def rename_tag():
+            tag = Tag.objects.get(value='django')
+            tag.value = 'flask'
+            tag.save()
+
+        def tag_through_reverse_relation():
+            Tag.objects.create(value='go').resources.add(self.bookmarks[0].resource)
+
+        edits = [
+            lambda: self.bookmarks[2].delete(),
+            edit_resource,
+            lambda: self.bookmarks[1].resource.tags.remove(Tag.objects.get(value='python')),
+            rename_tag,
+            lambda: Tag.objects.get(value='rust').delete(),
+            tag_through_reverse_relation,
+            lambda: Tag.objects.get(value='go').resources.clear(),
+            lambda: self.bookmarks[3].resource.delete(),
+        ]
+        for edit in edits:
+            self.settle()
+            edit()
+            self.assertSameAsDatabase()
+
+    def test_changes_from_other_processes(self):
+        model = readmodel.get_read_model()
+        # another process deletes a bookmark; this process gets no signal
+        deleted_id = self.bookmarks[2].id
+        with self.settings(BOOKMARKS_READ_MODEL=False):
+            self.bookmarks[2].delete()
+        BookmarkChange.record([deleted_id])
+        with self.settings(BOOKMARKS_READ_MODEL_CHECK_INTERVAL=60):
+            self.assertIs(readmodel.get_read_model(), model)
+        self.assertEqual(len(readmodel.get_read_model()), 3)
+        self.assertSameAsDatabase()
+
+    def test_reloaded_after_pruned_changes(self):
+        readmodel.get_read_model()
+        with self.settings(BOOKMARKS_READ_MODEL=False):
+            self.bookmarks[0].update_and_save({'title': 'Edited', 'uri': 'https://example.net/a', 'tags': 'go'}, NOW)
+        BookmarkChange.record([self.bookmarks[0].id])
+        BookmarkChange.objects.update(changed=NOW)
+        # prunes the change above, which this process has not seen yet
+        BookmarkChange.record([self.bookmarks[1].id])
+        self.assertSameAsDatabase()
+
+    def test_list_page_same_as_database(self):
+        params = {'tag': 'python'}
+        with self.settings(BOOKMARKS_READ_MODEL=False):
+            expected = self.client.get(reverse('list_bookmarks'), params).content
+        self.assertEqual(self.client.get(reverse('list_bookmarks'), params).content, expected)
+
+
+class FakeResponse:
+    def __init__(self, body: bytes, status_code: int = 200):
+        self.body = body
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = {'Content-Type': 'text/html; charset=utf-8'}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+
+class ArchiveTestCase(TestCase):
+    BODY = b'<html><title>Archived</title>' + bytes(range(256)) * 400 + b'</html>'
+
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        settings = self.settings(BOOKMARKS_ARCHIVE_DIR=self.root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.resource = Resource.objects.create(uri='https://example.com/page', title='Example')
+        self.bookmark = Bookmark.objects.create(resource=self.resource, created=NOW, modified=NOW)
+
+    def stored_files(self):
+        return [name for _dirpath, _dirnames, names in os.walk(self.root) for name in names]
+
+
+class ArchiveStoreTest(ArchiveTestCase):
+    def test_streamed_write_round_trip(self):
+        store = ArchiveStore(self.root, 1024 ** 2, 'gzip')
+        content = store.write(self.BODY[i:i + 1000] for i in range(0, len(self.BODY), 1000))
+        self.assertEqual(content.size, len(self.BODY))
+        self.assertLess(content.stored_size, content.size)
+        self.assertEqual(b''.join(store.read(content)), self.BODY)
+        self.assertEqual(b''.join(store.read(content, 100, 2000)), self.BODY[100:2000])
+
+    def test_read_closes_file(self):
+        store = ArchiveStore(self.root, 1024 ** 2, 'gzip')
+        content = store.write([self.BODY])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', ResourceWarning)
+            b''.join(store.read(content))
+            gc.collect()
+        self.assertEqual([w for w in caught if issubclass(w.category, ResourceWarning)], [])
+
+    def test_identical_bodies_are_stored_once(self):
+        store = ArchiveStore(self.root, 1024 ** 2, 'gzip')
+        first = store.write([self.BODY])
+        second = store.write([self.BODY[:10], self.BODY[10:]])
+        self.assertEqual(first.digest, second.digest)
+        self.assertEqual(ArchivedContent.objects.count(), 1)
+        self.assertEqual(len(self.stored_files()), 1)
+
+    def test_failed_write_leaves_no_files(self):
+        def chunks():
+            yield b'partial'
+            raise OSError
+
+        store = ArchiveStore(self.root, 1024 ** 2, 'gzip')
+        with self.assertRaises(OSError):
+            store.write(chunks())
+        self.assertEqual(self.stored_files(), [])
+        self.assertFalse(ArchivedContent.objects.exists())
+
+    def test_eviction_drops_least_recently_used(self):
+        bodies = [os.urandom(1000) for _ in range(3)]
+        store = ArchiveStore(self.root, 2500, 'gzip')
+        oldest, recent = store.write([bodies[0]]), store.write([bodies[1]])
+        for content in (oldest, recent):
+            Snapshot.objects.create(
+                resource=self.resource,
+                uri=self.resource.uri,
+                content=content,
+                content_type='text/plain',
+                fetched=NOW,
+            )
+        # reading the older content makes the other one the least recently used
+        b''.join(store.read(oldest))
+        newest = store.write([bodies[2]])
+        self.assertEqual(
+            set(ArchivedContent.objects.values_list('digest', flat=True)),
+            {oldest.digest, newest.digest}
+        )
+        self.assertEqual(list(Snapshot.objects.values_list('content', flat=True)), [oldest.digest])
+        self.assertEqual(len(self.stored_files()), 2)
+        self.assertLessEqual(store.total_size(), 2500)
+
+    def test_stale_incoming_files_are_removed(self):
+        stale, fresh = (os.path.join(self.root, INCOMING_PREFIX + name) for name in ('stale', 'fresh'))
+        for path in (stale, fresh):
+            open(path, 'wb').close()
+        old = time.time() - STALE_INCOMING_SECONDS - 1
+        os.utime(stale, (old, old))
+        ArchiveStore(self.root, 1024 ** 2, 'gzip').write([self.BODY])
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+
+
+class ArchiveResourceTest(ArchiveTestCase):
+    @mock.patch('bookmarks.archive.requests.get')
+    def test_archive(self, get):
+        get.return_value = FakeResponse(self.BODY)
+        snapshot = archive_resource(self.resource)
+        get.assert_called_once_with('https://example.com/page', stream=True, timeout=10)
+        self.assertEqual(snapshot.content_type, 'text/html; charset=utf-8')
+        self.assertEqual(snapshot.content.size, len(self.BODY))
+
+    @override_settings(BOOKMARKS_ARCHIVE_DIR=None)
+    @mock.patch('bookmarks.archive.requests.get')
+    def test_disabled(self, get):
+        self.assertIsNone(archive_resource(self.resource))
+        get.assert_not_called()
+
+    @mock.patch('bookmarks.archive.requests.get')
+    def test_error_status(self, get):
+        get.return_value = FakeResponse(b'Not found', status_code=404)
+        with self.assertLogs('bookmarks.archive', 'WARNING'):
+            self.assertIsNone(archive_resource(self.resource))
+        self.assertFalse(Snapshot.objects.exists())
+
+    @mock.patch('bookmarks.archive.requests.get')
+    def test_connection_error(self, get):
+        get.side_effect = requests.ConnectionError('connection refused')
+        with self.assertLogs('bookmarks.archive', 'WARNING'):
+            self.assertIsNone(archive_resource(self.resource))
+        self.assertFalse(Snapshot.objects.exists())
+
+    @override_settings(BOOKMARKS_ARCHIVE_MAX_PAGE_BYTES=1000)
+    @mock.patch('bookmarks.archive.requests.get')
+    def test_page_too_large(self, get):
+        get.return_value = FakeResponse(self.BODY)
+        with self.assertLogs('bookmarks.archive', 'WARNING'):
+            self.assertIsNone(archive_resource(self.resource))
+        self.assertFalse(ArchivedContent.objects.exists())
+        self.assertEqual(self.stored_files(), [])
+
+
+class ByteRangeTest(TestCase):
+    def byte_range(self, header):
+        return byte_range(RequestFactory().get('/', HTTP_RANGE=header), 1000)
+
+    def test_ranges(self):
+        self.assertEqual(self.byte_range('bytes=0-99'), (0, 100))
+        self.assertEqual(self.byte_range('bytes=900-'), (900, 1000))
+        self.assertEqual(self.byte_range('bytes=900-5000'), (900, 1000))
+        self.assertEqual(self.byte_range('bytes=-100'), (900, 1000))
+        self.assertEqual(self.byte_range('bytes=-5000'), (0, 1000))
+
+    def test_ignored(self):
+        self.assertIsNone(byte_range(RequestFactory().get('/'), 1000))
+        self.assertIsNone(self.byte_range('bytes=5-3'))
+        self.assertIsNone(self.byte_range('bytes=0-1,5-6'))
+        self.assertIsNone(self.byte_range('items=0-1'))
+
+    def test_unsatisfiable(self):
+        for header in ('bytes=1000-', 'bytes=2000-3000', 'bytes=-0'):
+            with self.subTest(header=header), self.assertRaises(ValueError):
+                self.byte_range(header)
+
+
+class ShowSnapshotTest(ArchiveTestCase):
+    def setUp(self):
+        super().setUp()
+        with mock.patch('bookmarks.archive.requests.get', return_value=FakeResponse(self.BODY)):
+            archive_resource(self.resource)
+        self.url = reverse('show_snapshot', kwargs={'bookmark_id': self.bookmark.id})
+
+    def test_whole_body(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/html; charset=utf-8')
+        self.assertEqual(response['Content-Length'], str(len(self.BODY)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Security-Policy'], 'sandbox')
+        self.assertEqual(b''.join(response.streaming_content), self.BODY)
+
+    def test_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.BODY)}')
+        self.assertEqual(b''.join(response.streaming_content), self.BODY[100:200])
+
+    def test_suffix_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-7')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'</html>')
+
+    def test_invalid_range_sends_whole_body(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=5-3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.BODY)
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.BODY)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.BODY)}')
+
+    def test_no_snapshot(self):
+        Snapshot.objects.all().delete()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_missing_file(self):
+        for dirpath, _dirnames, names in os.walk(self.root):
+            for name in names:
+                os.unlink(os.path.join(dirpath, name))
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_evicted_after_lookup(self):
+        with mock.patch.object(ArchivedContent.objects, 'filter') as content_filter:
+            content_filter.return_value.update.return_value = 0
+            self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_snapshot_of_previous_uri(self):
+        self.bookmark.update_and_save({'uri': 'https://example.com/other', 'title': 'Other', 'tags': ''})
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    @override_settings(BOOKMARKS_ARCHIVE_DIR=None)
+    def test_disabled(self):
+        self.assertEqual(self.client.get(self.url).status_code, 404)
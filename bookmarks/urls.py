@@ -4,5 +4,6 @@ from . import views
 
 urlpatterns = [
     path('', views.bookmarks_page, name='bookmarks_page'),
-    path('<int:bookmark_id>', views.show_bookmark, name='show_bookmark')
+    path('<int:bookmark_id>', views.show_bookmark, name='show_bookmark'),
+    path('<int:bookmark_id>/snapshot', views.show_snapshot, name='show_snapshot')
 ]
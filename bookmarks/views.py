@@ -1,17 +1,24 @@
+import re
 from cgi import parse_header
+from typing import Optional, Tuple
 from urllib.parse import urlencode
 
 from django.core.exceptions import BadRequest
 from django.core.paginator import Paginator, Page
-from django.http import JsonResponse, HttpRequest
+from django.http import Http404, HttpRequest, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
+from django.utils.http import http_date
 from django.views.decorators.http import require_safe
 
-from .models import Bookmark
+from .archive import get_store, latest_snapshot
+from .models import ArchivedContent, Bookmark
+from .readmodel import filtered_bookmarks
 
 PAGE_SIZE = 10
 
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
 
 class URL:
     def __init__(self, base, **params):
@@ -20,7 +27,7 @@ class URL:
 
     def __str__(self):
         if self.params:
-            return self.base + '?' + urlencode(self.params)
+            return self.base + '?' + urlencode(self.params, doseq=True)
         else:
             return self.base
 
@@ -47,7 +54,9 @@ class AnnotationCollection:
 
     def __init__(self, request: HttpRequest):
         self.request = request
-        self.paginator = Paginator(Bookmark.objects.all().order_by('-created'), PAGE_SIZE)
+        self.filters = filter_parameters(request)
+        self.bookmarks = filtered_bookmarks(self.filters.get('tag', ()), self.filters.get('domain'))
+        self.paginator = Paginator(self.bookmarks, PAGE_SIZE)
 
     def json(self):
         return {
@@ -66,14 +75,14 @@ class AnnotationCollection:
 
     @property
     def url(self):
-        return URL(self.request.build_absolute_uri(reverse('bookmarks_page')))
+        return URL(self.request.build_absolute_uri(reverse('bookmarks_page')), **self.filters)
 
     def metadata(self) -> dict:
         return {
             'id': str(self.url),
-            'total': len(self.paginator.object_list),
+            'total': self.paginator.count,
             # get the most recent modification timestamp
-            'modified': Bookmark.objects.all().order_by('-modified')[0].modified,
+            'modified': self.bookmarks.last_modified(),
             'label': 'Bookmarks Collection',
             'first': str(self.url + {'page': 1}),
             'last': str(self.url + {'page': self.paginator.num_pages})
@@ -122,6 +131,19 @@ class AnnotationCollection:
         return links
 
 
+def filter_parameters(request: HttpRequest) -> dict:
+    """
+    Returns the query parameters that narrow down the list of bookmarks, so that
+    they can be carried over into paging and facet links.
+    """
+    filters = {}
+    if 'tag' in request.GET:
+        filters['tag'] = request.GET.getlist('tag')
+    if request.GET.get('domain'):
+        filters['domain'] = request.GET['domain']
+    return filters
+
+
 def annotation(bookmark):
     return {
         'type': 'Annotation',
@@ -206,3 +228,76 @@ def show_bookmark(request: HttpRequest, bookmark_id: int):
             'Allow': 'GET, HEAD, OPTIONS'
         }
     )
+
+
+def byte_range(request: HttpRequest, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Returns the (start, end) byte positions, end exclusive, requested by a
+    single range in the Range header, or None to send the whole body. Raises
+    ValueError if the range cannot be satisfied, i.e. it starts at or past the
+    end of the body.
+    """
+    match = RANGE_PATTERN.match(request.headers.get('Range', '').strip())
+    if match is None:
+        # no Range header, or one we do not support (e.g. multiple ranges)
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            # syntactically invalid, so ignored rather than unsatisfiable
+            return None
+        end = min(int(last) + 1, size) if last else size
+    elif last:
+        # suffix range: the final bytes of the body
+        start = max(size - int(last), 0)
+        end = size
+    else:
+        return None
+    if start >= end:
+        raise ValueError
+    return start, end
+
+
+@require_safe
+def show_snapshot(request: HttpRequest, bookmark_id: int):
+    store = get_store()
+    if store is None:
+        raise Http404('Archiving is not enabled')
+    bookmark = get_object_or_404(Bookmark, pk=bookmark_id)
+    snapshot = latest_snapshot(bookmark.resource)
+    if snapshot is None:
+        raise Http404('No snapshot of this bookmark')
+
+    content = snapshot.content
+    headers = {
+        'Accept-Ranges': 'bytes',
+        # archived pages must not run scripts on our origin
+        'Content-Security-Policy': 'sandbox',
+        'Last-Modified': http_date(snapshot.fetched.timestamp()),
+    }
+    try:
+        requested = byte_range(request, content.size)
+    except ValueError:
+        return HttpResponse(status=416, headers={**headers, 'Content-Range': f'bytes */{content.size}'})
+
+    start, end = requested or (0, content.size)
+    # open the body before sending any headers, in case it has been evicted
+    try:
+        body = store.read(content, start, end)
+    except (FileNotFoundError, ArchivedContent.DoesNotExist):
+        raise Http404('Snapshot is no longer archived')
+
+    if requested is None:
+        response = StreamingHttpResponse(body, content_type=snapshot.content_type, headers=headers)
+        response['Content-Length'] = content.size
+        return response
+
+    response = StreamingHttpResponse(
+        body,
+        status=206,
+        content_type=snapshot.content_type,
+        headers={**headers, 'Content-Range': f'bytes {start}-{end - 1}/{content.size}'}
+    )
+    response['Content-Length'] = end - start
+    return response
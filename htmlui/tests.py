@@ -1,3 +1,73 @@
-from django.test import TestCase
+from datetime import datetime, timezone
+from unittest import mock
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from bookmarks.models import ArchivedContent, Bookmark, Resource, Snapshot
+
+NOW = datetime(2021, 12, 1, tzinfo=timezone.utc)
+
+
+class ListBookmarksFacetsTest(TestCase):
+    def setUp(self):
+        for uri, tags in [
+            ('https://example.com/a', 'python django'),
+            ('https://example.com/b', 'python'),
+            ('urn:isbn:0451450523', 'books'),
+            ('http://[abc/x', 'python'),
+        ]:
+            resource = Resource.objects.create(uri=uri, title=uri)
+            bookmark = Bookmark.objects.create(resource=resource, created=NOW, modified=NOW)
+            bookmark.update_tags(tags)
+
+    def test_domain_facet_links_filter_to_their_count(self):
+        response = self.client.get(reverse('list_bookmarks'))
+        facets = [facet for facet in response.context['domain_facets'] if facet['domain']]
+        self.assertEqual([(f['domain'], f['count']) for f in facets], [('example.com', 2)])
+        for facet in facets:
+            with self.subTest(domain=facet['domain']):
+                self.assertEqual(self.client.get(facet['url']).context['paginator'].count, facet['count'])
+
+    def test_empty_domain_is_not_linked(self):
+        content = self.client.get(reverse('list_bookmarks')).content.decode()
+        self.assertIn('<li class="facet-value">(none) (2)</li>', content)
+        self.assertNotIn('?domain="', content)
+
+    def test_tag_facet_links_add_to_filter(self):
+        response = self.client.get(reverse('list_bookmarks'), {'tag': 'python'})
+        self.assertEqual(response.context['paginator'].count, 3)
+        facets = response.context['tag_facets']
+        self.assertEqual([(f['value'], f['count']) for f in facets], [('django', 1)])
+        self.assertEqual(facets[0]['url'], '/?tag=python&tag=django')
+        self.assertEqual(self.client.get(facets[0]['url']).context['paginator'].count, 1)
+
+
+class EditBookmarkTest(TestCase):
+    def setUp(self):
+        self.resource = Resource.objects.create(uri='https://example.com/a', title='A')
+        self.bookmark = Bookmark.objects.create(resource=self.resource, created=NOW, modified=NOW)
+        self.url = reverse('edit_bookmark', kwargs={'bookmark_id': self.bookmark.id})
+        content = ArchivedContent.objects.create(digest='0' * 64, encoding='gzip', size=0, stored_size=0, last_accessed=NOW)
+        Snapshot.objects.create(
+            resource=self.resource,
+            uri=self.resource.uri,
+            content=content,
+            content_type='text/html',
+            fetched=NOW,
+        )
+
+    @override_settings(BOOKMARKS_ARCHIVE_DIR='/nonexistent')
+    def test_archived_copy_link(self):
+        self.assertContains(self.client.get(self.url), 'Archived copy')
+
+    @override_settings(BOOKMARKS_ARCHIVE_DIR=None)
+    def test_no_archived_copy_link_when_disabled(self):
+        self.assertNotContains(self.client.get(self.url), 'Archived copy')
+
+    @mock.patch('htmlui.views.archive_in_background')
+    def test_archived_again_when_uri_changes(self, archive_in_background):
+        self.client.post(self.url, {'uri': 'https://example.com/a', 'title': 'Renamed', 'tags': ''})
+        archive_in_background.assert_not_called()
+        self.client.post(self.url, {'uri': 'https://example.com/b', 'title': 'Renamed', 'tags': ''})
+        archive_in_background.assert_called_once_with(self.bookmark.resource)
@@ -7,7 +7,10 @@ from django.http import HttpRequest, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
 
+from bookmarks.archive import archive_in_background, latest_snapshot
 from bookmarks.models import Bookmark, Resource
+from bookmarks.readmodel import filtered_bookmarks
+from bookmarks.views import URL, filter_parameters
 from htmlui.forms import BookmarkForm
 
 
@@ -37,15 +40,24 @@ def list_bookmarks(request: HttpRequest):
                 }
                 return render(request, 'htmlui/bookmark_form.html', context=context)
 
-        bookmarks = Bookmark.objects.all()
-        if 'tag' in request.GET:
-            # do the intersection of all tags
-            bookmarks = bookmarks.intersection(
-                *(bookmarks.filter(resource__tags__value=tag) for tag in request.GET.getlist('tag'))
-            )
-        bookmarks = bookmarks.order_by('-created')
+        filters = filter_parameters(request)
+        tags = filters.get('tag', [])
+        bookmarks = filtered_bookmarks(tags, filters.get('domain'))
         paginator = Paginator(bookmarks, 10)
-        context = {'paginator': paginator, 'bookmarks': paginator.get_page(1)}
+        url = URL(reverse('list_bookmarks'), **filters)
+        context = {
+            'paginator': paginator,
+            'bookmarks': paginator.get_page(1),
+            'filters': filters,
+            'domain_facets': [
+                {**facet, 'url': str(url + {'domain': facet['domain']})}
+                for facet in bookmarks.domain_counts()
+            ],
+            'tag_facets': [
+                {**facet, 'url': str(url + {'tag': [*tags, facet['value']]})}
+                for facet in bookmarks.tag_counts() if facet['value'] not in tags
+            ],
+        }
         return render(request, 'htmlui/bookmarks_list.html', context=context)
 
     elif request.method == 'POST':
@@ -59,23 +71,36 @@ def list_bookmarks(request: HttpRequest):
             now = datetime.now()
             bookmark = Bookmark.objects.create(resource=resource, created=now, modified=now)
             bookmark.update_and_save(data, now)
+            archive_in_background(resource)
         else:
             bookmark = resource.bookmark
-            bookmark.update_and_save(data)
+            update_and_archive(bookmark, data)
         return HttpResponseRedirect(reverse('htmlui/bookmark_form.html', kwargs={'bookmark_id': bookmark.id}))
 
 
+def update_and_archive(bookmark: Bookmark, data: dict):
+    old_uri = bookmark.resource.uri
+    bookmark.update_and_save(data)
+    if bookmark.resource.uri != old_uri:
+        # snapshots of the old URI are not served for the new one
+        archive_in_background(bookmark.resource)
+
+
 def edit_bookmark(request: HttpRequest, bookmark_id: int):
     bookmark = get_object_or_404(Bookmark, pk=bookmark_id)
 
     if request.method == 'GET':
-        return render(request, 'htmlui/bookmark_form.html', context={'bookmark': bookmark, 'form': BookmarkForm.from_bookmark(bookmark)})
+        return render(request, 'htmlui/bookmark_form.html', context={
+            'bookmark': bookmark,
+            'form': BookmarkForm.from_bookmark(bookmark),
+            'snapshot': latest_snapshot(bookmark.resource),
+        })
     elif request.method == 'POST':
         form = BookmarkForm(request.POST)
 
         if not form.is_valid():
             return render(request, 'htmlui/bookmark_form.html', context={'form': form})
 
-        bookmark.update_and_save(form.cleaned_data)
+        update_and_archive(bookmark, form.cleaned_data)
 
         return HttpResponseRedirect(reverse('edit_bookmark', kwargs={'bookmark_id': bookmark.id}))